@@ -1,5 +1,8 @@
 import socket
 import threading
+import argparse
+import traffic_trace
+import profiler
 
 # --- CONFIGURATION ---
 # The address where the Relay Server will listen
@@ -10,7 +13,12 @@ RELAY_PORT = 6667
 TARGET_HOST = '127.0.0.1'
 TARGET_PORT = 6666
 
-def forward_stream(source, destination):
+CONTROL_PORT = 6669  # Local profiler control socket (see profiler.py)
+
+# Set by --capture: records all relayed traffic for chat_replay.py
+trace_writer = None
+
+def forward_stream(source, destination, session_id=None, direction=None):
     """
     Handles one-way data forwarding from a source socket to a destination socket.
     This function creates a transparent bridge for traffic.
@@ -18,12 +26,16 @@ def forward_stream(source, destination):
     Args:
         source (socket): The socket receiving data.
         destination (socket): The socket where data is forwarded.
+        session_id (int): Trace session id, used when capture is enabled.
+        direction (int): traffic_trace.CLIENT_TO_SERVER or SERVER_TO_CLIENT.
     """
     while True:
         try:
             data = source.recv(1024)
             if not data:
                 break
+            if trace_writer:
+                trace_writer.record(session_id, direction, data)
             destination.send(data)
         except:
             break
@@ -48,6 +60,7 @@ def handle_relay_client(client_socket):
     """
     # 1. Connect to the Main Server
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    session_id = trace_writer.new_session() if trace_writer else None
     
     try:
         server_socket.connect((TARGET_HOST, TARGET_PORT))
@@ -59,7 +72,13 @@ def handle_relay_client(client_socket):
         client_socket.send(server_request)
         
         # B. Receive the original nickname from the Client
-        original_nick = client_socket.recv(1024).decode('utf-8')
+        raw_nick = client_socket.recv(1024)
+        original_nick = raw_nick.decode('utf-8')
+        
+        # The trace stores what the client saw, so it can be replayed against the relay or the server
+        if trace_writer:
+            trace_writer.record(session_id, traffic_trace.SERVER_TO_CLIENT, server_request)
+            trace_writer.record(session_id, traffic_trace.CLIENT_TO_SERVER, raw_nick)
         
         # C. Relay prepends '*' to the nickname
         modified_nick = "*" + original_nick
@@ -70,9 +89,9 @@ def handle_relay_client(client_socket):
         
         # --- START BIDIRECTIONAL COMMUNICATION (Threading) ---
         # Thread 1: Client -> Server
-        t1 = threading.Thread(target=forward_stream, args=(client_socket, server_socket))
+        t1 = threading.Thread(target=forward_stream, args=(client_socket, server_socket, session_id, traffic_trace.CLIENT_TO_SERVER))
         # Thread 2: Server -> Client
-        t2 = threading.Thread(target=forward_stream, args=(server_socket, client_socket))
+        t2 = threading.Thread(target=forward_stream, args=(server_socket, client_socket, session_id, traffic_trace.SERVER_TO_CLIENT))
         
         t1.start()
         t2.start()
@@ -93,13 +112,27 @@ def start_relay():
     
     print(f"Relay Server running on {RELAY_HOST}:{RELAY_PORT}")
     print(f"Forwarding to Main Server at {TARGET_HOST}:{TARGET_PORT}")
+    profiler.start_control_server(CONTROL_PORT, "relay")
     
-    while True:
-        client, addr = relay.accept()
-        print(f"Incoming connection to Relay: {addr}")
-        
-        thread = threading.Thread(target=handle_relay_client, args=(client,))
-        thread.start()
+    try:
+        while True:
+            client, addr = relay.accept()
+            print(f"Incoming connection to Relay: {addr}")
+            
+            thread = threading.Thread(target=handle_relay_client, args=(client,))
+            thread.start()
+    except KeyboardInterrupt:
+        if trace_writer:
+            trace_writer.close()
+            print("Capture saved.")
+        relay.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat relay server")
+    parser.add_argument('--capture', metavar='TRACE_FILE',
+                        help="record all relayed traffic to a binary trace file")
+    args = parser.parse_args()
+    if args.capture:
+        trace_writer = traffic_trace.TraceWriter(args.capture)
+        print(f"Capturing traffic to {args.capture}")
     start_relay()
\ No newline at end of file
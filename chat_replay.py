@@ -0,0 +1,252 @@
+import socket
+import threading
+import argparse
+import time
+import random
+import sys
+import traffic_trace
+
+# --- CONFIGURATION ---
+REPLY_TIMEOUT = 2.0   # Seconds to wait for the server to answer a replayed frame
+
+class SessionReplay:
+    """
+    Re-drives one captured client session against a server.
+    Each client frame is sent at its (scaled) capture time; the session then waits
+    for the server line answering it, which gives the per-frame latency.
+    Nicknames and /msg targets get a per-run suffix, so offline mail stored by
+    earlier runs is never delivered to (or fills the mailbox of) a later run.
+    """
+    def __init__(self, frames, host, port, speed, replay_start, run_tag):
+        """
+        Args:
+            frames (list): (offset, direction, data) tuples from read_trace().
+            host (str): Target server address.
+            port (int): Target server port.
+            speed (float): Time acceleration factor, 0 means as fast as possible.
+            replay_start (float): time.monotonic() value shared by all sessions.
+            run_tag (str): Suffix appended to every nickname of this run.
+        """
+        self.frames = [frame for frame in frames if frame[1] == traffic_trace.CLIENT_TO_SERVER]
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.replay_start = replay_start
+        self.run_tag = run_tag
+        self.sock = None
+        self.nickname = None
+        self.buffer = ""
+        self.latencies = []
+        self.timeouts = 0
+        self.frames_sent = 0
+        self.bytes_received = 0
+        self.error = None
+
+    def wait_until(self, offset):
+        if self.speed <= 0:
+            return
+        delay = self.replay_start + offset / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def read_until(self, matches):
+        """
+        Reads lines until one satisfies `matches` or REPLY_TIMEOUT passes.
+
+        Returns:
+            str: The matching line, or None on timeout.
+        """
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while True:
+            while '\n' in self.buffer:
+                line, self.buffer = self.buffer.split('\n', 1)
+                if matches(line):
+                    return line
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                return None
+            if not data:
+                return None
+            self.bytes_received += len(data)
+            self.buffer += data.decode('utf-8', errors='replace')
+
+    def prepare(self, data):
+        """
+        Rewrites a captured frame for this run and builds the predicate that
+        recognises the server's answer to it.
+
+        Returns:
+            tuple: (bytes to send, predicate or None if the server sends no reply).
+        """
+        payload = data.decode('utf-8', errors='replace').strip()
+        if self.nickname is None:
+            payload = f"{payload}.{self.run_tag}"
+            return payload.encode('utf-8'), lambda line: line.startswith('Connected as ') or line == 'REFUSE'
+        if not payload:
+            return data, None
+        if payload.startswith('/msg'):
+            parts = payload.split(' ', 2)
+            if len(parts) < 3:
+                return data, None  # The server ignores incomplete /msg commands
+            target = f"{parts[1]}.{self.run_tag}"
+            payload = f"/msg {target} {parts[2]}"
+            expected = f"[To] {target}: {parts[2]}"
+        else:
+            expected = f"{self.nickname}: {payload}"
+        # The server handles a frame as one message; a frame holding several lines
+        # is echoed as several lines, so only the first one is matched.
+        expected = expected.split('\n', 1)[0].rstrip()
+        if payload.startswith('/msg'):
+            return payload.encode('utf-8'), lambda line: line.rstrip() == expected or line.startswith('[System]')
+        return payload.encode('utf-8'), lambda line: line.rstrip().endswith(expected)
+
+    def run(self):
+        if not self.frames:
+            return
+        try:
+            self.wait_until(self.frames[0][0])
+            self.sock = socket.create_connection((self.host, self.port))
+            if self.read_until(lambda line: line == 'NICK') is None:
+                raise RuntimeError("no NICK request from server")
+
+            for offset, _, data in self.frames:
+                self.wait_until(offset)
+                data, matches = self.prepare(data)
+                sent_at = time.monotonic()
+                self.sock.send(data)
+                self.frames_sent += 1
+                if matches is None:
+                    continue
+                line = self.read_until(matches)
+                if line is None:
+                    self.timeouts += 1
+                    continue
+                self.latencies.append(time.monotonic() - sent_at)
+                if self.nickname is None:
+                    if line == 'REFUSE':
+                        raise RuntimeError("nickname refused by server")
+                    self.nickname = line[len('Connected as '):]
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.sock:
+                self.sock.close()
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def replay(sessions, host, port, speed):
+    """
+    Replays all sessions of a trace concurrently against one server, once.
+
+    Returns:
+        tuple: (list of finished SessionReplay objects, wall time in seconds).
+    """
+    run_tag = f"r{random.randrange(16 ** 4):04x}"
+    replay_start = time.monotonic()
+    replays = [SessionReplay(frames, host, port, speed, replay_start, run_tag) for frames in sessions.values()]
+    threads = [threading.Thread(target=session.run) for session in replays]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.monotonic() - replay_start
+
+    for session in replays:
+        if session.error:
+            print(f"  session error: {session.error}")
+    return replays, wall_time
+
+def summarize(runs):
+    """
+    Pools the measured runs of one target into summary statistics.
+
+    Args:
+        runs (list): (replays, wall_time) tuples returned by replay().
+
+    Returns:
+        dict: Summary statistics of the runs.
+    """
+    replays = [session for sessions, _ in runs for session in sessions]
+    wall_time = sum(wall for _, wall in runs)
+    latencies = [latency for session in replays for latency in session.latencies]
+    frames_sent = sum(session.frames_sent for session in replays)
+    return {
+        'runs': len(runs),
+        'sessions': len(replays),
+        'frames': frames_sent,
+        'timeouts': sum(session.timeouts for session in replays),
+        'errors': sum(1 for session in replays if session.error),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies, default=0.0) * 1000,
+        'wall_s': wall_time,
+        'frames_per_s': frames_sent / wall_time if wall_time else 0.0,
+        'rx_kb_per_s': sum(session.bytes_received for session in replays) / 1024 / wall_time if wall_time else 0.0,
+    }
+
+def print_report(results):
+    """Prints one column per target; later targets show their change relative to the first."""
+    targets = list(results)
+    print()
+    print(f"{'metric':<14}" + "".join(f"{target:>26}" for target in targets))
+    baseline = results[targets[0]]
+    for metric in baseline:
+        row = f"{metric:<14}"
+        for target in targets:
+            value = results[target][metric]
+            cell = f"{value:.2f}" if isinstance(value, float) else str(value)
+            if target != targets[0] and baseline[metric]:
+                cell += f" ({(value - baseline[metric]) / baseline[metric] * 100:+.1f}%)"
+            row += f"{cell:>26}"
+        print(row)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a traffic trace captured with --capture")
+    parser.add_argument('trace', help="trace file to replay")
+    parser.add_argument('--target', action='append', metavar='HOST:PORT',
+                        help="server to replay against, repeat to compare builds (default 127.0.0.1:6666)")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="time acceleration, e.g. 1 or 10; 0 replays as fast as possible")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="measured runs per target, pooled in the report (default 3)")
+    parser.add_argument('--warmup', type=int, default=1,
+                        help="unmeasured runs per target before measuring (default 1)")
+    args = parser.parse_args()
+
+    try:
+        sessions = traffic_trace.read_trace(args.trace)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    frame_count = sum(len(frames) for frames in sessions.values())
+    print(f"Loaded {len(sessions)} session(s), {frame_count} frame(s) from {args.trace}")
+
+    targets = [(f"#{number} {target}", target.rsplit(':', 1))
+               for number, target in enumerate(args.target or ['127.0.0.1:6666'], 1)]
+    speed_label = "max" if args.speed <= 0 else f"{args.speed:g}x"
+
+    # Warm-up runs are not measured; measured runs alternate between targets
+    # so that drift on the benchmark machine affects every build alike.
+    for name, (host, port) in targets:
+        for _ in range(args.warmup):
+            print(f"Warm-up against {name}...")
+            replay(sessions, host, int(port), args.speed)
+    runs = {name: [] for name, _ in targets}
+    for repeat in range(1, args.repeat + 1):
+        for name, (host, port) in targets:
+            print(f"Run {repeat}/{args.repeat} against {name} at {speed_label} speed...")
+            runs[name].append(replay(sessions, host, int(port), args.speed))
+    print_report({name: summarize(target_runs) for name, target_runs in runs.items()})
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,25 @@ import threading
 import random
 import datetime
 import sys
+import argparse
+import offline_store
+import profiler
+import traffic_trace
 
 # --- CONFIGURATION ---
 HOST = '127.0.0.1'
 PORT = 6666
+CONTROL_PORT = 6668  # Local profiler control socket (see profiler.py)
+STORE_PATH = offline_store.STORE_FILE  # Changed with --store
+
+# Set by --capture: records every client message for chat_replay.py
+trace_writer = None
 
 clients = []
 nicknames = []
+# Guards "is the user online?" against logins, so a /msg is either sent
+# directly or stored before the recipient's offline mail is delivered
+presence_lock = threading.Lock()
 
 def write_log(message):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -33,12 +45,20 @@ def broadcast_user_list():
     users_str = "LIST:" + ",".join(nicknames)
     broadcast(users_str)
 
-def handle_client(client):
+def handle_client(client, session_id=None):
     while True:
         try:
             # Receive and clean message
-            message = client.recv(1024).decode('utf-8').strip()
-            if not message: break
+            data = client.recv(1024)
+            if trace_writer and data:
+                trace_writer.record(session_id, traffic_trace.CLIENT_TO_SERVER, data)
+            # Empty read means the peer closed; go through the cleanup below
+            if not data: raise ConnectionError("client closed the connection")
+            # Spans start once data has arrived; idle time in recv() is not a stage
+            span = profiler.start_span()
+            message = data.decode('utf-8').strip()
+            profiler.mark(span, 'decode')
+            if not message: continue
             
             if client in clients:
                 index = clients.index(client)
@@ -47,43 +67,88 @@ def handle_client(client):
             
             current_time = datetime.datetime.now().strftime("%H:%M")
 
+            # Stages: parse (split) -> route (pick target / store) -> fan-out (sends) -> log
             if message.startswith('/msg'):
                 parts = message.split(' ', 2)
+                profiler.mark(span, 'parse')
                 if len(parts) >= 3:
                     target_name = parts[1]
                     content = parts[2]
                     
-                    if target_name in nicknames:
-                        target_index = nicknames.index(target_name)
-                        target_client = clients[target_index]
-                        
+                    target_client = None
+                    with presence_lock:
+                        if target_name in nicknames:
+                            target_client = clients[nicknames.index(target_name)]
+                        else:
+                            refused = offline_store.store_message(target_name, sender_nick, content)
+                    profiler.mark(span, 'route')
+                    
+                    if target_client:
                         pm_to_target = f"[Private] {sender_nick}: {content}\n"
-                        target_client.send(pm_to_target.encode('utf-8'))
-                        
+                        try:
+                            target_client.send(pm_to_target.encode('utf-8'))
+                        except OSError:
+                            # Target left after the lookup; keep the message for its next login
+                            target_client = None
+                            refused = offline_store.store_message(target_name, sender_nick, content)
+                    
+                    if target_client:
                         pm_to_sender = f"[To] {target_name}: {content}\n"
                         client.send(pm_to_sender.encode('utf-8'))
+                        profiler.mark(span, 'fan-out')
                         
                         write_log(f"PRIVATE: {sender_nick} -> {target_name}: {content}")
+                        profiler.mark(span, 'log')
+                    elif not refused:
+                        client.send(f"[System]: User '{target_name}' is offline, message saved for delivery.\n".encode('utf-8'))
+                        profiler.mark(span, 'fan-out')
+                        write_log(f"OFFLINE: {sender_nick} -> {target_name}: {content}")
+                        profiler.mark(span, 'log')
                     else:
-                        client.send(f"[System]: User '{target_name}' not found.\n".encode('utf-8'))
+                        client.send(f"[System]: Message to '{target_name}' not saved: {refused}.\n".encode('utf-8'))
+                        profiler.mark(span, 'fan-out')
             else:
+                profiler.mark(span, 'parse')
                 formatted_message = f"[{current_time}] {sender_nick}: {message}"
+                profiler.mark(span, 'route')
                 broadcast(formatted_message)
+                profiler.mark(span, 'fan-out')
                 write_log(f"PUBLIC: {sender_nick}: {message}")
+                profiler.mark(span, 'log')
 
         except:
             if client in clients:
-                index = clients.index(client)
-                clients.remove(client)
-                client.close()
-                nickname = nicknames[index]
-                nicknames.remove(nickname)
+                with presence_lock:
+                    index = clients.index(client)
+                    clients.remove(client)
+                    client.close()
+                    nickname = nicknames[index]
+                    nicknames.remove(nickname)
                 
                 broadcast(f"{nickname} left the chat!")
                 broadcast_user_list()
                 write_log(f"DISCONNECT: {nickname}")
                 break
 
+def take_offline_messages(nickname):
+    """Removes and returns the pending offline messages of a user. Caller holds presence_lock."""
+    count, pending = offline_store.pending_messages(nickname)
+    offline_store.mark_delivered(nickname, count)
+    return pending
+
+def deliver_offline_messages(client, nickname, pending):
+    """Sends the messages from take_offline_messages() in one batched write."""
+    if not pending:
+        return
+    batch = ""
+    for stored_at, sender, content in pending:
+        sent_time = datetime.datetime.fromtimestamp(stored_at).strftime("%Y-%m-%d %H:%M")
+        batch += f"[Private] {sender}: (offline, {sent_time}) {content}\n"
+    try:
+        client.sendall(batch.encode('utf-8'))
+        write_log(f"OFFLINE DELIVERY: {len(pending)} message(s) -> {nickname}")
+    except: pass
+
 def shutdown_server(server):
     """Shuts down the server and cleans up all connections."""
     print("\n\n--- SERVER SHUTTING DOWN (Graceful Shutdown) ---")
@@ -97,6 +162,9 @@ def shutdown_server(server):
     
     # 3. Close main server socket
     server.close()
+    offline_store.close_store()
+    if trace_writer:
+        trace_writer.close()
     write_log("Server stopped manually via KeyboardInterrupt.")
     print("All connections closed. Port released.")
     sys.exit(0)
@@ -108,6 +176,8 @@ def receive():
     try:
         server.bind((HOST, PORT))
         server.listen()
+        offline_store.load_store(STORE_PATH)
+        profiler.start_control_server(CONTROL_PORT, "server")
         write_log(f"Server started on {HOST}:{PORT}. Press Ctrl+C to stop.")
     except Exception as e:
         print(f"Error: {e}")
@@ -120,28 +190,38 @@ def receive():
             
             # Handshake
             client.send('NICK\n'.encode('utf-8'))
-            nickname = client.recv(1024).decode('utf-8').strip()
+            raw_nick = client.recv(1024)
+            nickname = raw_nick.decode('utf-8').strip()
 
             if nickname.startswith('*'):
                 client.send('REFUSE\n'.encode('utf-8'))
                 client.close()
                 continue
 
-            original_nick = nickname
-            while nickname in nicknames:
-                suffix = random.randint(1, 999)
-                nickname = f"{original_nick}{suffix}"
-            
-            nicknames.append(nickname)
-            clients.append(client)
+            session_id = None
+            if trace_writer:
+                session_id = trace_writer.new_session()
+                trace_writer.record(session_id, traffic_trace.SERVER_TO_CLIENT, b'NICK\n')
+                trace_writer.record(session_id, traffic_trace.CLIENT_TO_SERVER, raw_nick)
+
+            with presence_lock:
+                original_nick = nickname
+                while nickname in nicknames:
+                    suffix = random.randint(1, 999)
+                    nickname = f"{original_nick}{suffix}"
+                
+                nicknames.append(nickname)
+                clients.append(client)
+                pending = take_offline_messages(nickname)
 
             write_log(f"Connected: {nickname}")
             broadcast(f"{nickname} joined the chat!")
             client.send(f"Connected as {nickname}\n".encode('utf-8'))
+            deliver_offline_messages(client, nickname, pending)
             
             broadcast_user_list()
 
-            thread = threading.Thread(target=handle_client, args=(client,))
+            thread = threading.Thread(target=handle_client, args=(client, session_id))
             thread.daemon = True # Thread dies when main program closes
             thread.start()
 
@@ -151,6 +231,18 @@ def receive():
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         server.close()
+        if trace_writer:
+            trace_writer.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument('--capture', metavar='TRACE_FILE',
+                        help="record every client message to a binary trace file")
+    parser.add_argument('--store', metavar='PATH', default=STORE_PATH,
+                        help=f"offline message store (default {STORE_PATH})")
+    args = parser.parse_args()
+    STORE_PATH = args.store
+    if args.capture:
+        trace_writer = traffic_trace.TraceWriter(args.capture)
+        print(f"Capturing traffic to {args.capture}")
     receive()
\ No newline at end of file
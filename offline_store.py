@@ -0,0 +1,278 @@
+import os
+import shutil
+import struct
+import threading
+import time
+from collections import Counter
+
+# --- CONFIGURATION ---
+STORE_FILE = "offline_messages.dat"
+MAX_PENDING_PER_USER = 50          # Quota: pending messages kept per recipient
+MAX_PENDING_PER_SENDER = 200       # Quota: pending messages one sender may have queued
+MAX_STORE_MESSAGES = 10000         # Global cap on pending messages (bounds file and memory)
+MESSAGE_TTL = 7 * 24 * 60 * 60     # Seconds before an undelivered message expires
+COMPACT_DEAD_RECORDS = 1000        # Rewrite the file once this many records are dead
+
+# --- RECORD FORMAT ---
+# The store is an append-only file of binary records (big-endian):
+#   MESSAGE: kind(1) stored_at(8) len(recipient)(2) len(sender)(2) len(content)(4) + utf-8 bytes
+#   CLEAR:   kind(1) stored_at(8) len(recipient)(2) delivered_count(4)    + utf-8 bytes
+# A CLEAR record marks the oldest `delivered_count` messages of a recipient as delivered.
+MAGIC = b'OFM1'
+KIND_MESSAGE = 1
+KIND_CLEAR = 2
+MESSAGE_HEADER = struct.Struct('>BdHHI')
+CLEAR_HEADER = struct.Struct('>BdHI')
+
+store_file = None
+store_path = None
+store_lock = threading.Lock()
+index = {}  # recipient -> list of (offset, stored_at, sender), oldest first
+sender_counts = Counter()  # sender -> messages in the index
+total_pending = 0          # messages in the index, expired ones included
+dead_records = 0           # delivered messages and CLEAR records still in the file
+
+def _read_record(f):
+    """
+    Reads one record at the current file position.
+
+    Returns:
+        tuple: (kind, stored_at, recipient, sender, content_or_count),
+        or None at end of file / on a truncated or corrupt record.
+    """
+    kind = f.read(1)
+    if not kind:
+        return None
+    if kind[0] == KIND_MESSAGE:
+        header = kind + f.read(MESSAGE_HEADER.size - 1)
+        if len(header) < MESSAGE_HEADER.size:
+            return None
+        _, stored_at, rlen, slen, clen = MESSAGE_HEADER.unpack(header)
+        body = f.read(rlen + slen + clen)
+        if len(body) < rlen + slen + clen:
+            return None
+        try:
+            recipient = body[:rlen].decode('utf-8')
+            sender = body[rlen:rlen + slen].decode('utf-8')
+            content = body[rlen + slen:].decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        return KIND_MESSAGE, stored_at, recipient, sender, content
+    if kind[0] == KIND_CLEAR:
+        header = kind + f.read(CLEAR_HEADER.size - 1)
+        if len(header) < CLEAR_HEADER.size:
+            return None
+        _, stored_at, rlen, count = CLEAR_HEADER.unpack(header)
+        body = f.read(rlen)
+        if len(body) < rlen:
+            return None
+        try:
+            recipient = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        return KIND_CLEAR, stored_at, recipient, None, count
+    return None
+
+def _encode_message(stored_at, recipient, sender, content):
+    r = recipient.encode('utf-8')
+    s = sender.encode('utf-8')
+    c = content.encode('utf-8')
+    return MESSAGE_HEADER.pack(KIND_MESSAGE, stored_at, len(r), len(s), len(c)) + r + s + c
+
+def _encode_clear(recipient, count):
+    r = recipient.encode('utf-8')
+    return CLEAR_HEADER.pack(KIND_CLEAR, time.time(), len(r), count) + r
+
+def _live_count(recipient, now):
+    # Expired entries stay in the index (CLEAR counts refer to it) until the next compaction
+    return sum(1 for entry in index.get(recipient, []) if now - entry[1] < MESSAGE_TTL)
+
+def _write_store(pending):
+    """
+    Rewrites the store with the given messages (atomic replace) and rebuilds
+    the index. Expired messages are dropped. Caller holds store_lock or is load_store.
+
+    Args:
+        pending (dict): recipient -> list of (stored_at, sender, content), oldest first.
+    """
+    global store_file, index, sender_counts, total_pending, dead_records
+
+    if store_file:
+        store_file.close()
+    now = time.time()
+    tmp_path = store_path + ".tmp"
+    index = {}
+    sender_counts = Counter()
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        for recipient, messages in pending.items():
+            for stored_at, sender, content in messages[-MAX_PENDING_PER_USER:]:
+                if now - stored_at >= MESSAGE_TTL:
+                    continue
+                index.setdefault(recipient, []).append((f.tell(), stored_at, sender))
+                sender_counts[sender] += 1
+                f.write(_encode_message(stored_at, recipient, sender, content))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, store_path)
+
+    store_file = open(store_path, 'a+b')
+    total_pending = sum(len(entries) for entries in index.values())
+    dead_records = 0
+
+def _compact():
+    """Drops delivered and expired records while the server runs. Caller holds store_lock."""
+    pending = {}
+    for recipient, entries in index.items():
+        for offset, _, _ in entries:
+            store_file.seek(offset)
+            record = _read_record(store_file)
+            if record is not None:
+                pending.setdefault(recipient, []).append((record[1], record[3], record[4]))
+    dead, before = dead_records, total_pending
+    _write_store(pending)
+    print(f"Offline store compacted: {dead} delivered record(s) and "
+          f"{before - total_pending} expired message(s) dropped, {total_pending} pending.")
+
+def load_store(path=STORE_FILE):
+    """
+    Opens the offline store and builds the in-memory recipient index.
+    The file is scanned once here; afterwards every lookup uses the index.
+    Delivered, expired and truncated records are compacted away on load.
+    If the file has a bad header or unreadable records, a copy is kept as
+    <path>.bad-<timestamp> before rewriting, so no mail is silently lost.
+
+    Args:
+        path (str): Location of the store file.
+    """
+    global store_path
+
+    pending = {}  # recipient -> list of (stored_at, sender, content)
+    total_records = 0
+    if os.path.exists(path):
+        readable_end = 0
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) == MAGIC:
+                readable_end = f.tell()
+                while True:
+                    record = _read_record(f)
+                    if record is None:
+                        break
+                    readable_end = f.tell()
+                    total_records += 1
+                    kind, stored_at, recipient, sender, value = record
+                    if kind == KIND_MESSAGE:
+                        pending.setdefault(recipient, []).append((stored_at, sender, value))
+                    else:
+                        del pending.get(recipient, [])[:value]
+        if readable_end < os.path.getsize(path):
+            backup_path = f"{path}.bad-{int(time.time())}"
+            shutil.copyfile(path, backup_path)
+            print(f"Offline store: unreadable data after byte {readable_end}, "
+                  f"original kept as {backup_path}")
+
+    with store_lock:
+        store_path = path
+        _write_store(pending)
+    print(f"Offline store loaded: {total_pending} pending message(s), "
+          f"{total_records - total_pending} record(s) compacted.")
+
+def _append_message(now, recipient, sender, content):
+    global total_pending
+    store_file.seek(0, os.SEEK_END)
+    offset = store_file.tell()
+    store_file.write(_encode_message(now, recipient, sender, content))
+    store_file.flush()
+    os.fsync(store_file.fileno())
+    index.setdefault(recipient, []).append((offset, now, sender))
+    sender_counts[sender] += 1
+    total_pending += 1
+
+def store_message(recipient, sender, content):
+    """
+    Appends a private message for an offline user.
+
+    Args:
+        recipient (str): Nickname the message is addressed to.
+        sender (str): Nickname of the sender.
+        content (str): The message text.
+
+    Returns:
+        str: None if stored, otherwise the reason it was refused.
+    """
+    with store_lock:
+        now = time.time()
+        if _live_count(recipient, now) >= MAX_PENDING_PER_USER:
+            return f"mailbox of '{recipient}' is full"
+        if sender_counts[sender] >= MAX_PENDING_PER_SENDER:
+            return "you have too many undelivered messages"
+        if total_pending >= MAX_STORE_MESSAGES:
+            # Expired messages still count until a compaction; only rewrite if it frees space
+            if any(now - entry[1] >= MESSAGE_TTL for entries in index.values() for entry in entries):
+                _compact()
+            if total_pending >= MAX_STORE_MESSAGES:
+                return "offline store is full"
+        _append_message(now, recipient, sender, content)
+        return None
+
+def pending_messages(recipient):
+    """
+    Reads the pending messages of a user using the index (no full scan).
+
+    Args:
+        recipient (str): Nickname that just connected.
+
+    Returns:
+        tuple: (count, messages) where messages is a list of
+        (stored_at, sender, content). Pass count to mark_delivered().
+    """
+    with store_lock:
+        entries = index.get(recipient, [])
+        now = time.time()
+        messages = []
+        for offset, stored_at, _ in entries:
+            if now - stored_at >= MESSAGE_TTL:
+                continue
+            store_file.seek(offset)
+            record = _read_record(store_file)
+            if record is not None:
+                messages.append((record[1], record[3], record[4]))
+        return len(entries), messages
+
+def mark_delivered(recipient, count):
+    """
+    Appends a CLEAR record so the first `count` messages are not delivered again.
+    Compacts the file once enough delivered records have piled up.
+
+    Args:
+        recipient (str): Nickname whose messages were delivered.
+        count (int): Number of messages returned by pending_messages().
+    """
+    global total_pending, dead_records
+    if count == 0:
+        return
+    with store_lock:
+        store_file.seek(0, os.SEEK_END)
+        store_file.write(_encode_clear(recipient, count))
+        store_file.flush()
+        os.fsync(store_file.fileno())
+        entries = index.get(recipient, [])
+        for _, _, sender in entries[:count]:
+            sender_counts[sender] -= 1
+            if sender_counts[sender] <= 0:
+                del sender_counts[sender]
+        del entries[:count]
+        if not entries:
+            index.pop(recipient, None)
+        total_pending -= count
+        dead_records += count + 1
+        if dead_records >= COMPACT_DEAD_RECORDS and dead_records > total_pending:
+            _compact()
+
+def close_store():
+    """Flushes and closes the store file."""
+    global store_file
+    with store_lock:
+        if store_file:
+            store_file.close()
+            store_file = None
@@ -0,0 +1,223 @@
+import socket
+import threading
+import random
+import datetime
+import time
+import sys
+import re
+import linecache
+from collections import Counter
+
+# --- CONFIGURATION ---
+CONTROL_HOST = '127.0.0.1'   # Control socket only listens locally
+SAMPLE_INTERVAL = 0.005      # Seconds between stack samples (200 Hz)
+MAX_DURATION = 300           # Upper limit for one profiling run, in seconds
+
+profile_lock = threading.Lock()   # Only one profiling run at a time
+
+# A sample is idle when the thread's innermost Python line is a blocking call
+# (the C call itself, e.g. socket.recv, has no Python frame of its own)
+IDLE_CALL = re.compile(r'\.(recv|recv_into|_accept|accept|sleep|select|wait|join)\(')
+IDLE_FRAME = "[idle]"
+
+# --- STAGE SPANS ---
+# Per-message timing, disabled (rate 0) unless a profiling run asks for it.
+span_rate = 0.0
+span_lock = threading.Lock()
+span_stats = {}  # stage -> [count, total_seconds, max_seconds]
+
+def start_span():
+    """
+    Starts timing a message if it is selected for sampling.
+
+    Returns:
+        list: [last_mark_time] for a sampled message, None otherwise.
+    """
+    if span_rate <= 0 or random.random() >= span_rate:
+        return None
+    return [time.perf_counter()]
+
+def mark(span, stage):
+    """
+    Closes the current stage of a sampled message and starts the next one.
+
+    Args:
+        span (list): Value returned by start_span(), may be None.
+        stage (str): Name of the stage that just finished (e.g. 'decode').
+    """
+    if span is None:
+        return
+    now = time.perf_counter()
+    elapsed = now - span[0]
+    span[0] = now
+    with span_lock:
+        stats = span_stats.setdefault(stage, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+def format_span_stats(stats):
+    lines = [f"{'stage':<10}{'count':>8}{'avg_us':>12}{'max_us':>12}"]
+    for stage, (count, total, longest) in stats.items():
+        lines.append(f"{stage:<10}{count:>8}{total / count * 1e6:>12.1f}{longest * 1e6:>12.1f}")
+    return "\n".join(lines)
+
+# --- SAMPLING PROFILER ---
+def thread_label(thread):
+    # "Thread-7 (handle_client)" -> "handle_client", so threads of one kind merge
+    match = re.match(r'^Thread-\d+ \((.*)\)$', thread.name)
+    return match.group(1) if match else thread.name
+
+def is_idle(frame):
+    line = linecache.getline(frame.f_code.co_filename, frame.f_lineno)
+    return IDLE_CALL.search(line) is not None
+
+def sample_stacks(duration, interval=SAMPLE_INTERVAL):
+    """
+    Samples the stacks of all other threads for `duration` seconds.
+    Stacks of threads blocked in recv/accept/sleep get an extra "[idle]" leaf,
+    so flamegraphs can separate waiting from work.
+
+    Returns:
+        tuple: (Counter of collapsed stacks, number of samples taken).
+    """
+    stacks = Counter()
+    samples = 0
+    own_ident = threading.get_ident()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        labels = {thread.ident: thread_label(thread) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            names = [IDLE_FRAME] if is_idle(frame) else []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            names.append(labels.get(ident, str(ident)))
+            stacks[";".join(reversed(names))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+def run_profile(label, duration, rate):
+    """
+    Runs one profiling session and writes a collapsed-stack file.
+
+    Args:
+        label (str): 'server' or 'relay', used in the output file name.
+        duration (float): Seconds to sample.
+        rate (float): Fraction of messages (0..1) that record stage spans.
+
+    Returns:
+        str: Human readable report for the control client.
+    """
+    global span_rate
+    if not profile_lock.acquire(blocking=False):
+        return "ERROR: a profiling run is already active."
+    try:
+        with span_lock:
+            span_stats.clear()
+        span_rate = rate
+        stacks, samples = sample_stacks(duration)
+        span_rate = 0.0
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = f"profile_{label}_{timestamp}.folded"
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        busy = Counter({stack: count for stack, count in stacks.items()
+                        if not stack.endswith(";" + IDLE_FRAME)})
+        idle_samples = sum(stacks.values()) - sum(busy.values())
+        report = [f"Profiled {label} for {duration:g}s: {samples} samples, "
+                  f"{len(stacks)} unique stacks -> {path}"]
+        report.append(f"Idle thread samples (blocked in recv/accept/sleep): {idle_samples}")
+        report.append("Top busy stacks:")
+        for stack, count in busy.most_common(5):
+            frames = stack.split(';')
+            report.append(f"  {count:>6}  [{frames[0]}] {frames[-1]}")
+        if not busy:
+            report.append("  (none, all threads were idle)")
+        with span_lock:
+            stats = dict(span_stats)
+        if stats:
+            report.append(format_span_stats(stats))
+        return "\n".join(report)
+    finally:
+        span_rate = 0.0
+        profile_lock.release()
+
+# --- CONTROL SOCKET ---
+def handle_control_client(conn, label):
+    """
+    Serves one control connection. Commands (one line):
+        profile <seconds> [span_rate]
+    """
+    try:
+        parts = conn.recv(1024).decode('utf-8').split()
+        if len(parts) in (2, 3) and parts[0] == 'profile':
+            duration = min(float(parts[1]), MAX_DURATION)
+            rate = float(parts[2]) if len(parts) == 3 else 0.0
+            # Written as "not (...)" so that NaN is rejected too
+            if not duration > 0:
+                reply = "ERROR: seconds must be greater than 0."
+            elif not 0.0 <= rate <= 1.0:
+                reply = "ERROR: span_rate must be between 0 and 1."
+            else:
+                conn.sendall(f"Profiling {label} for {duration:g}s...\n".encode('utf-8'))
+                reply = run_profile(label, duration, rate)
+        else:
+            reply = "Usage: profile <seconds> [span_rate 0..1]"
+        conn.sendall((reply + "\n").encode('utf-8'))
+    except Exception as e:
+        try:
+            conn.sendall(f"ERROR: {e}\n".encode('utf-8'))
+        except: pass
+    finally:
+        conn.close()
+
+def control_loop(control, label):
+    while True:
+        try:
+            conn, _ = control.accept()
+        except OSError:
+            break
+        thread = threading.Thread(target=handle_control_client, args=(conn, label))
+        thread.daemon = True
+        thread.start()
+
+def start_control_server(port, label):
+    """
+    Starts the local profiling control socket in a daemon thread.
+
+    Args:
+        port (int): Port on 127.0.0.1 to listen on.
+        label (str): Name of the process being profiled ('server' or 'relay').
+    """
+    control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    control.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        control.bind((CONTROL_HOST, port))
+        control.listen()
+    except Exception as e:
+        print(f"Profiler control socket disabled: {e}")
+        return
+    print(f"Profiler control socket on {CONTROL_HOST}:{port}")
+    thread = threading.Thread(target=control_loop, args=(control, label))
+    thread.daemon = True
+    thread.start()
+
+if __name__ == "__main__":
+    # Usage: python3 profiler.py <port> <seconds> [span_rate]
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python3 profiler.py <control_port> <seconds> [span_rate]")
+        sys.exit(1)
+    with socket.create_connection((CONTROL_HOST, int(sys.argv[1]))) as conn:
+        conn.sendall(("profile " + " ".join(sys.argv[2:]) + "\n").encode('utf-8'))
+        while True:
+            data = conn.recv(4096)
+            if not data: break
+            print(data.decode('utf-8'), end="")
@@ -0,0 +1,95 @@
+import struct
+import threading
+import time
+
+# --- TRACE FORMAT ---
+# Binary trace of per-session frames (big-endian):
+#   header: magic(4) capture_start(8)
+#   frame:  session_id(4) offset_seconds(8) direction(1) length(4) + raw bytes
+# The offset is measured from capture_start, so a trace can be replayed at any speed.
+# Traces come from chat_server.py --capture (one frame per message the server parses)
+# or chat_relay.py --capture (raw relayed chunks, both directions).
+MAGIC = b'CTR1'
+FILE_HEADER = struct.Struct('>4sd')
+FRAME_HEADER = struct.Struct('>IdBI')
+
+CLIENT_TO_SERVER = 0
+SERVER_TO_CLIENT = 1
+
+class TraceWriter:
+    """
+    Thread-safe writer that appends timestamped frames to a trace file.
+    Shared by all client threads of the server or forwarding threads of the relay.
+    """
+    def __init__(self, path):
+        """
+        Creates the trace file and writes its header.
+
+        Args:
+            path (str): Location of the trace file.
+        """
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.next_session = 0
+        self.file.write(FILE_HEADER.pack(MAGIC, time.time()))
+        self.file.flush()
+
+    def new_session(self):
+        """
+        Returns:
+            int: A unique id for a newly connected client.
+        """
+        with self.lock:
+            self.next_session += 1
+            return self.next_session
+
+    def record(self, session_id, direction, data):
+        """
+        Appends one frame to the trace.
+
+        Args:
+            session_id (int): Id returned by new_session().
+            direction (int): CLIENT_TO_SERVER or SERVER_TO_CLIENT.
+            data (bytes): The raw bytes as seen on the wire.
+        """
+        offset = time.monotonic() - self.start
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(FRAME_HEADER.pack(session_id, offset, direction, len(data)) + data)
+            # Flush every frame so a killed or crashed process still leaves a usable
+            # trace; read_trace() ignores a final frame that was cut off.
+            self.file.flush()
+
+    def close(self):
+        """Flushes and closes the trace file."""
+        with self.lock:
+            self.file.close()
+
+def read_trace(path):
+    """
+    Loads a trace file.
+
+    Args:
+        path (str): Location of the trace file.
+
+    Returns:
+        dict: session_id -> list of (offset_seconds, direction, data), in capture order.
+        A truncated final frame (e.g. relay killed mid-write) is ignored.
+    """
+    sessions = {}
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[0] != MAGIC:
+            raise ValueError(f"{path} is not a traffic trace")
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                break
+            session_id, offset, direction, length = FRAME_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            sessions.setdefault(session_id, []).append((offset, direction, data))
+    return sessions